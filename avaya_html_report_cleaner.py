@@ -12,13 +12,13 @@ absolute coordinates, e.g. each <label> at the same height can be considered to
 same row. From here a pandas dataframe is constructed and some basic cleanup is done.
 
 EXTERNAL DEPENDENCIES::
-- beautifulsoup4
 - lxml
 - numpy
 - pandas
-- sqlalchemy
+- pyarrow
+- pyodbc (only with --useSQL)
 
-->> pip install beautifulsoup4 lxml pandas numpy sqlalchemy
+->> pip install lxml pandas numpy pyarrow pyodbc
 
 Build Environment: 
     Date: 2022-04-29
@@ -39,6 +39,51 @@ Style Notes:
         interpreted and executed; if not, and the script is being imported, no code is executed and only static
         objects are available to the importing script, i.e. classes, functions, etc.
 """
+import re
+import numpy as np
+
+#! module-level constants
+#?-------------------------------------------------------------------------
+#* compiled once at import; each pulls a single pixel offset out of a label's inline CSS
+_TOP_RE = re.compile(r'(?:^|;)\s*top:\s*(-?\d+)px')
+_LEFT_RE = re.compile(r'(?:^|;)\s*left:\s*(-?\d+)px')
+_META_RE = re.compile(r'[A-Za-z\s]+:(?![0-9])') #* "Key:" metadata labels, but not clock times like "10:30"
+_WS_RE = re.compile(r' +')
+_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE) #* matches both <meta charset> and http-equiv forms
+_NBSP_TO_SPACE = str.maketrans({u'\xa0': u' '}) #* str.translate tables for the interior &nbsp; left after .strip()
+_NBSP_TO_BAR = str.maketrans({u'\xa0': u'|'}) #* title fragments are separated by runs of &nbsp;
+_TITLE_FONT = "font:bold 12px verdana" #* inline CSS declaration carried by column title labels
+_JUNK_RE = re.compile(r'[A-Za-z]|--+|^$') #* TIME cells to throw out: letters, "--" rules, or empty
+_DATE_FORMAT = "%I:%M %p %a %b %d, %Y" #* metadata "Date:" stamps, e.g. "10:30 AM Mon Apr 25, 2022"
+_SQL_CHUNK_ROWS = 10000 #* rows per executemany batch on the SQL export path
+
+#! helpers
+#?-------------------------------------------------------------------------
+def group_sort(rows, cols):
+    #? Sort label coordinates by (ROW, COL) and find where each row's run of labels starts.
+    #? Kept purely numeric; the caller reorders its texts with the returned order.
+    if rows.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    row_min, col_min = np.int64(rows.min()), np.int64(cols.min())
+    col_span = np.int64(cols.max()) - col_min + 1
+    key = (rows.astype(np.int64) - row_min) * col_span + (cols.astype(np.int64) - col_min) #* one int64 key ordered like (row, col)
+    order = np.argsort(key, kind='mergesort') #* stable, labels sharing a (row, col) pair keep their document order
+    rows_s = rows[order]
+    new_row = np.empty(rows_s.size, dtype=np.bool_)
+    new_row[0] = True
+    new_row[1:] = rows_s[1:] != rows_s[:-1]
+    return order, np.nonzero(new_row)[0]
+
+
+def label_string(el):
+    #? lxml counterpart of BeautifulSoup's Tag.string, which the scrape originally relied on:
+    #? the text of an element with no children, or of its sole child (recursively) when that child is all it contains,
+    #? e.g. <label><span>8:00</span></label> -> "8:00". Mixed content gives None, as it did with bs4.
+    if len(el) == 0:
+        return el.text
+    if len(el) == 1 and not el.text and not el[0].tail:
+        return label_string(el[0])
+    return None
 
 
 def main(TARGET_FILE:str, useSQL:bool = False):
@@ -50,168 +95,175 @@ def main(TARGET_FILE:str, useSQL:bool = False):
 
     #! pkg imports
     #?-------------------------------------------------------------------------
-    from bs4 import BeautifulSoup as bs
-    from bs4 import UnicodeDammit
+    from lxml import etree
     import pandas as pd
-    import numpy as np
-    import re
     import datetime as dt
+    from array import array
     
-    #! non-anon function definitions
-    #?-------------------------------------------------------------------------
-    def css_to_dict(css_str):
-        out_dict = {}
-        _css_str = str(css_str)
-        css_list = _css_str.split(sep="; ")
-        for i in css_list:
-            elet = i.split(':')
-            #* trailing ";" in initial CSS generates a list containing an empty string, skip iteration if this is the case.
-            if elet == ['']: 
-                continue
-            out_dict[elet[0]] = elet[1]    # "append" key-value pair to dict
-        return out_dict
-
-    def get_coordinates(css_dict):
-        i_coord = int(css_dict["top"].replace("px","")) #row index
-        j_coord = int(css_dict["left"].replace("px","")) #column index
-        return (i_coord, j_coord)
-
-    def get_index(css_str):
-        return get_coordinates(css_to_dict(css_str))
-
     #! main runtime
     #?-------------------------------------------------------------------------
-    with open(TARGET_FILE, "r") as f:
-        phone_data = UnicodeDammit(f.read()).unicode_markup #force unicode.
-
-    doc = bs(phone_data, "lxml")
-
-    Label_elets = []
-    for i in doc.find_all("label"):
-        Label_elets.append(i)
-
-    #? data points of the form [(col,row), "Data"] ::: col->int, row->int, "Data"->string.
-    #? (col, row) pairs are scraped from the inline styling of each label tag
+    #* sniff the declared encoding from the first 4 KB only, rather than probing the whole buffer;
+    #* if none is declared, or libxml2 does not know the declared one, assume UTF-8;
+    #* left to itself libxml2 falls back to Latin-1 and garbles undeclared UTF-8 reports
+    with open(TARGET_FILE, "rb") as f:
+        charset = _CHARSET_RE.search(f.read(4096))
+    encoding = charset.group(1).decode("ascii") if charset != None else "utf-8"
+    if encoding != "utf-8":
+        #* ask libxml2 itself rather than codecs.lookup(); Python knows codecs (e.g. cp437) that libxml2 rejects
+        try:
+            etree.HTMLParser(encoding=encoding)
+        except LookupError: #* unknown or misspelled charset, e.g. "x-user-defined"; same UTF-8 fallback as no charset at all
+            encoding = "utf-8"
+
+    #? data points are kept as parallel sequences rows[k], cols[k], texts[k] ::: row->int, col->int, "Data"->string.
+    #? (row, col) pairs are scraped from the inline styling of each label tag
     #? It is beyond the author's comprehension as to WHY these data were not just packed in an HTML table in the first place.
-    indexed_data = []
-    _col_titles = []
-    for i in Label_elets:
-        if i.string == None:
-            continue
-        if css_to_dict(i["style"])["font"] == "bold 12px verdana":
-            _col_titles.append(re.split(r'\|+', i.string.strip().replace(u'\xa0', u'|')))
-        indexed_data.append([get_index(i["style"]), i.string.strip().replace(u'\xa0', u' ')]) #* .strip() call removes HTML &nbsp; (\xa0 in unicode)
-
-
-    #? Handle Column titles being broken into multiple, fragmented rows
+    rows = array('i') #* typed, growable int buffers; the label count is unknown until the stream is exhausted
+    cols = array('i')
+    texts = []
+    #? Column titles are broken into multiple, fragmented rows of "bold" labels
     #? See minor comments (#* ...) for some explanation of the dancing around we do here
-    max_title_list_length = max(len(x) for x in _col_titles)
-    col_titles = []
-    for i in _col_titles:
-        if i == ['']:
+    col_titles = [] #* first two title fragment lists of the longest length seen so far, any more are redundant
+    max_title_list_length = 0
+    #* stream <label> elements straight off disk instead of reading, decoding and parsing the whole document up front;
+    #* iterparse is consumed directly, no intermediate list of label elements is ever materialized
+    for _event, i in etree.iterparse(TARGET_FILE, events=("end",), tag="label", html=True, recover=True, encoding=encoding):
+        style, text = i.get("style"), label_string(i)
+        #* free each label once read, along with any already-processed siblings, to keep the working set bounded
+        i.clear()
+        while i.getprevious() is not None:
+            del i.getparent()[0]
+        if text == None or style == None:
             continue
-        elif len(i) < max_title_list_length: #* admittedly this is a fragile clause; it depends on there being more than a single maximum length list in _col_titles
-            continue
-        else:
-            if len(col_titles) == 2: break #* break out of loop once we have first two instances, any more are redundant
-            col_titles.append(i)
-
-    zip_col_titles = zip(*col_titles) #* unpack nested list col_titles, then zip sublists together (element-wise tuple concat)
-    final_col_titles = []
-    for i in zip_col_titles:
-        final_col_titles.append(" ".join(i)) #* join tuples resulting from zip into final strings
-    final_col_titles.insert(0, "TIME") #* add Time title that isn't included in a "bold" styled <label>
-
-
-
-    #? Get all unique ROW indices from each [(col,ROW), "data"]
-    row_indices_set = set() #* We do a little trick and use a set object to guarantee uniqueness for free
-    for i in indexed_data:
-        row_indices_set.add(i[0][0])
-
-    #? enforce ordering on row index values
-    row_indices_list = list(row_indices_set)
-    row_indices_list.sort()
-
-    #? Take ordered row indices and retrieve all data points that fall in that row, adding them to matrix_dict
-    #? matrix dict is of the form: 
-    #? {row index i : [ [(i,col index j_1), "Data"],...,[(i,col index j_n), "Data"] ]} ::: i->int, j_k->int, "Data"->string
-    #? i.e. it is a dict of lists of lists 
-    matrix_dict = {}
-    for i in row_indices_list:
-        matrix_dict[i] = []
-        for j in indexed_data:
-            if j[0][0] == i:
-                matrix_dict[i].append(j)
-
-
-    #? Sub-sort column elements in each row entry of matrix_dict.
+        text = text.strip() #* .strip() call removes leading/trailing HTML &nbsp; (\xa0 in unicode)
+        if _TITLE_FONT in style: #* plain substring test, no need to parse the whole inline CSS for one key
+            title = re.split(r'\|+', text.translate(_NBSP_TO_BAR))
+            if title == ['']:
+                pass
+            elif len(title) > max_title_list_length: #* a longer fragment list supersedes everything collected so far
+                max_title_list_length, col_titles = len(title), [title]
+            elif len(title) == max_title_list_length and len(col_titles) < 2:
+                col_titles.append(title)
+        rows.append(int(_TOP_RE.search(style).group(1))) #row index
+        cols.append(int(_LEFT_RE.search(style).group(1))) #column index
+        texts.append(text.translate(_NBSP_TO_SPACE))
+
+    #* view the int buffers as numpy arrays without copying; texts becomes the matching object array
+    rows = np.frombuffer(rows, dtype=np.intc)
+    cols = np.frombuffer(cols, dtype=np.intc)
+    texts = np.array(texts, dtype=object)
+
+
+    #? Stitch the collected title fragments back together
+    #* col_titles was picked in the same pass as the scrape, so there is no second walk to find the longest fragment list;
+    #* a single maximal list is fine too, but a report without any "bold" title labels can't be untangled at all
+    if len(col_titles) == 0:
+        raise ValueError(f"no column title labels ({_TITLE_FONT}) found in {TARGET_FILE}")
+    #* unpack nested list col_titles, zip sublists together (element-wise tuple concat), then join each tuple into a final string
+    #* "TIME" is prepended since its title isn't included in a "bold" styled <label>
+    final_col_titles = ["TIME"] + [" ".join(i) for i in zip(*col_titles)]
+
+
+
+    #? Sort every label by (ROW, COL) in one pass, see group_sort().
     #? We technically get total ordering of rows for free from the inherent structure
     #? of the HTML document, but I do not trust that to always be the case, so we force a total ordering.
-    sorted_rows_dict = {}
-    for i in matrix_dict.keys():
-        row = []
-        matrix_dict[i].sort(key=lambda x: x[0][1])
-        for j in matrix_dict[i]:
-            row.append(j[1])
-        sorted_rows_dict[i] = row
+    order, starts = group_sort(rows, cols)
+    rows_s = rows[order]
+    texts_s = texts[order]
+
+    #? Sorted labels now sit in contiguous runs, one per unique ROW index; starts marks the first label of each run.
+    #? sorted_rows_dict is of the form {row index i : ["Data_1",...,"Data_n"]} with row data already in column order
+    uniq = rows_s[starts]
+    ends = np.append(starts[1:], len(rows_s))
+    inverse = np.repeat(np.arange(len(starts)), ends - starts) #* row number of each sorted label
+    sorted_rows_dict = {i: texts_s[j:k].tolist() for i, j, k in zip(uniq.tolist(), starts, ends)}
 
     metadata_dict={}
     for _key,val in sorted_rows_dict.items():
         if len(val) == 1:
-            if re.match(pattern = r'[A-z\s]+:(?![0-9])', string = val[0]) != None:
+            if _META_RE.match(val[0]) != None:
                 datum = val[0].split(":")
                 metadata_dict[datum[0].strip()] = datum[1].strip()
             continue
-        for i in val:
-            if re.match(pattern = r'[A-z\s]+:(?![0-9])', string = i) != None:
-                metadata_dict[re.sub(r' +', r' ', i[:-1])] = re.sub(r' +', r' ',val[val.index(i)+1]) #* re.sub statements are to deal with extraneous whitespace
+        for idx, i in enumerate(val):
+            if _META_RE.match(i) != None:
+                metadata_dict[_WS_RE.sub(' ', i[:-1])] = _WS_RE.sub(' ', val[idx+1]) #* _WS_RE.sub statements are to deal with extraneous whitespace
     
     #// TODO: fix "Date:" timestamps to be in unix standard time in metadata
     _timestamp = metadata_dict["Date"]
-    fixed_timestamp = dt.datetime.strptime(_timestamp, "%I:%M %p %a %b %d, %Y")
+    fixed_timestamp = dt.datetime.strptime(_timestamp, _DATE_FORMAT)
     metadata_dict["Date"] = fixed_timestamp
 
 
-    #? Construct final dataframe such that each key-value pair is a ROW
-    df = pd.DataFrame.from_dict(sorted_rows_dict, orient='index')
+    #? Scatter each label into table[row, position within row] so no per-row Python lists are pivoted.
+    pos = np.arange(len(rows_s)) - starts[inverse]
+    table = np.full((len(uniq), pos.max() + 1), None, dtype=object) #* short rows stay padded with None
+    table[inverse, pos] = texts_s
 
-    #* produce a deep copy of df, dropping rows whose 0th element contains letters
-    #* use deep copy to avoid returning a view, which is non-deterministic 
-    df1 = df[~df[0].str.contains("[a-zA-Z]").fillna(False)].copy(deep=True)
+    #* drop rows whose 0th element is missing, empty, a "--" rule, or contains letters, then strip spaces from the survivors.
+    #* both happen on the raw object table before pandas is involved, so there are no Series round-trips,
+    #* no inplace block copies and no deep copy of a filtered view
+    keep = np.array([isinstance(s, str) and _JUNK_RE.search(s) == None for s in table[:, 0]], dtype=bool)
+    table = table[keep]
+    table[:, 0] = [_WS_RE.sub('', s) for s in table[:, 0]]
 
-    df1[0].replace('',np.nan, inplace=True)
-    df1[0].replace(r'--+',np.nan, inplace=True, regex=True)
-    df1.dropna(subset=[0], inplace=True)
-    df1[0].replace(r' +', '', inplace=True, regex=True)
+    #? Construct final dataframe such that each kept ROW index is a row, filling the frame column-wise.
+    df1 = pd.DataFrame({j: table[:, j] for j in range(table.shape[1])}, copy=False)
     df1.columns = final_col_titles
-    df1.reset_index(drop=True, inplace=True)
 
     #* prepend metadata columns for use with relational databases
-    for k,v in metadata_dict.items():
-        df1.insert(0, k, [v for _ in range(len(df1.index))])
+    #* built as one frame and concatenated once; inserting column by column re-consolidates df1 on every insert
+    #* items are reversed to keep the column order the old insert(0, ...) loop produced
+    meta_df = pd.DataFrame(dict(reversed(metadata_dict.items())), index=df1.index) #* scalar values broadcast over the index
+    df1 = pd.concat([meta_df, df1], axis=1)
     #df1.insert(0,"uuid", [uuid.uuid4() for _ in range(len(df1.index))]) #don't really need uuids, but good to have options
 
 
     #? Handle Data Export to target destination, dependent on argv "useSQL"
-    #! for info on building your connection string, see SQLAlchemy docs: https://www.sqlalchemy.org/library.html#reference
+    #! for info on building your connection string, see pyodbc docs: https://github.com/mkleehammer/pyodbc/wiki/Connecting-to-SQL-Server-from-Windows
     #! the below is written with MSSQL in mind, but can be easily adapted to use Postgres or mysql
     if useSQL == False:
-        df1.to_csv(f"phone_data_{TARGET_FILE}.csv")
+        import pyarrow as pa
+        import pyarrow.csv as pcsv
+        #* Arrow's C++ CSV writer serializes whole columns at once instead of formatting cell by cell in Python
+        table = pa.Table.from_pandas(df1, preserve_index=False)
+        #* datetime64 columns (the metadata "Date") arrive at sub-second resolution and Arrow would write the fraction out;
+        #* cast to whole seconds so stamps are written as "2022-04-25 10:30:00"
+        for idx, field in enumerate(table.schema):
+            if pa.types.is_timestamp(field.type):
+                table = table.set_column(idx, field.name, table.column(idx).cast(pa.timestamp("s", tz=field.type.tz)))
+        #* output format (see README): header row, no index column, every string cell double-quoted,
+        #* numbers/timestamps/missing cells unquoted; "needed" is Arrow's default, spelled out so the format is pinned
+        pcsv.write_csv(table, f"phone_data_{TARGET_FILE}.csv", write_options=pcsv.WriteOptions(quoting_style="needed"))
     else:
-        import sqlalchemy
+        import pyodbc
         server = 'YOUR SERVER HERE'
         database = 'YOUR DB HERE'
-        mssql_conn_string = f"mssql+pyodbc://{server}/{database}" #* no credential spec for testing purposes; some variety of auth will be needed for full deployment
-
-        engine = sqlalchemy.create_engine(mssql_conn_string, fast_executemany=True) #* Note the fast_executemany flag prebuffers all rows in RAM; DO NOT USE WITH LARGE DATA SETS
-        with engine.connect() as connection:
-            if 'Skill' in df1.columns:
-                print('query to Skill table in mssql')
-            if 'VDN' in df1.columns:
-                print('query to VDN table in mssql')
-            print('imagine a SQL transaction is happening here. It will look like df1.to_sql(name=\'target_table\', con=connection)')
-        
+        mssql_conn_string = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={server};DATABASE={database};Trusted_Connection=yes" #* no credential spec for testing purposes; some variety of auth will be needed for full deployment
+
+        if 'Skill' in df1.columns:
+            print('query to Skill table in mssql')
+        if 'VDN' in df1.columns:
+            print('query to VDN table in mssql')
+
+        #* fast_executemany keeps the ODBC bulk parameter path, but rows are handed over _SQL_CHUNK_ROWS at a time
+        #* so only a single chunk is ever buffered, never the whole frame
+        col_names = ", ".join(f"[{c}]" for c in df1.columns)
+        placeholders = ", ".join("?" for _ in df1.columns)
+        insert_sql = f"INSERT INTO target_table ({col_names}) VALUES ({placeholders})"
+        conn = pyodbc.connect(mssql_conn_string)
+        try:
+            cur = conn.cursor()
+            cur.fast_executemany = True
+            for start in range(0, len(df1.index), _SQL_CHUNK_ROWS):
+                chunk = df1.iloc[start:start + _SQL_CHUNK_ROWS].astype(object)
+                chunk = chunk.where(chunk.notna(), None) #* NaN -> None so missing cells bind as SQL NULL
+                cur.executemany(insert_sql, list(chunk.itertuples(index=False, name=None)))
+            conn.commit()
+        finally:
+            conn.close()
+
 
     #? create exceptions for log testing
     #exception_generator = 1/0 #! I THROW EXCEPTIONS AND CAUSE PROBLEMS